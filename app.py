@@ -8,8 +8,8 @@ import streamlit as st
 # ---- CONFIG ----
 st.set_page_config(page_title="SmartLinks for Real Estate", page_icon="🔗", layout="wide")
 
-# Resolve backend base URL (Secrets > BACKEND_BASE recommended)
-BACKEND_BASE = st.secrets.get("BACKEND_BASE", os.getenv("BACKEND_BASE", "http://localhost:8000"))
+# Resolve backend base URL (Secrets > BACKEND_BASE recommended); normalized once, no trailing slash
+BACKEND_BASE = st.secrets.get("BACKEND_BASE", os.getenv("BACKEND_BASE", "http://localhost:8000")).rstrip("/")
 
 # Small helper to call backend safely
 def api_get(path, params=None, timeout=12):
@@ -93,7 +93,7 @@ def create_smartlink(url: str, maybe_slug: str | None):
         data = {"owner_id": st.session_state.owner["owner_id"], "url": url, "slug": (maybe_slug or None)}
         res = api_post("/api/links/create", data)
         short = res.get("short_url", "")
-        st.success(f"SmartLink created: {BACKEND_BASE.rstrip('/')}{short}")
+        st.success(f"SmartLink created: {BACKEND_BASE}{short}")
     except requests.HTTPError as he:
         st.error(he.response.text)
     except Exception as e:
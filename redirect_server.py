@@ -1,17 +1,27 @@
 # redirect_server.py
 # SmartLinks – FastAPI backend with owners table + Stripe checkout + plan gating
 import os
+import atexit
 import hashlib
+import logging
+import secrets
 import sqlite3
 import json
+import re
+import threading
+import time
 import datetime as dt
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from functools import lru_cache
 from typing import Optional
+from urllib.parse import quote
 
-import stripe
 from fastapi import FastAPI, Request, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, EmailStr
-from fastapi.responses import RedirectResponse
+from fastapi.responses import Response
 
 # -------- ENV --------
 STRIPE_API_KEY = os.getenv("STRIPE_API_KEY", "")
@@ -19,56 +29,186 @@ STRIPE_PRICE_ID = os.getenv("STRIPE_PRICE_ID", "")  # $29/mo price id
 STRIPE_WEBHOOK_SECRET = os.getenv("STRIPE_WEBHOOK_SECRET", "")
 PUBLIC_APP_DOMAIN = os.getenv("PUBLIC_APP_DOMAIN", "http://localhost:8501")  # success/cancel URLs
 DB_PATH = os.getenv("DB_PATH", "smartlinks.sqlite3")
+FREE_LINK_LIMIT = 3
+# >0 lets browsers/CDNs reuse redirects for that many seconds; repeat scans within
+# the window never reach us, so click counts go down. Off by default.
+REDIRECT_MAX_AGE = int(os.getenv("REDIRECT_MAX_AGE", "0"))
+# comma-separated; the Streamlit app calls us server-side, so browsers only matter for embeds
+CORS_ORIGINS = [o.strip() for o in os.getenv("CORS_ORIGINS", "*").split(",") if o.strip()]
 
-if STRIPE_API_KEY:
-    stripe.api_key = STRIPE_API_KEY
+@lru_cache(maxsize=None)
+def get_stripe():
+    # imported on first use: redirect-only workers never pay for the SDK
+    import stripe
+    if STRIPE_API_KEY:
+        stripe.api_key = STRIPE_API_KEY
+    return stripe
+
+log = logging.getLogger("smartlinks")
+
+# bound once so hot handlers skip the module attribute walk per call
+_time_ns = time.time_ns
 
 # -------- APP --------
 app = FastAPI(title="SmartLinks API", version="1.0.0")
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"],
+    # no cookies or auth headers cross origins, so no credentials: with "*" Starlette then
+    # sends a fixed allow-origin instead of echoing each request's Origin back
+    allow_origins=CORS_ORIGINS, allow_credentials=False, allow_methods=["*"], allow_headers=["*"],
 )
 
 # -------- DB --------
-def get_db():
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+# Per-connection tuning; journal_mode=WAL is persistent and set once in init_db().
+_CONN_PRAGMAS = """
+PRAGMA busy_timeout=5000;
+PRAGMA synchronous=NORMAL;
+PRAGMA temp_store=MEMORY;
+PRAGMA cache_size=-64000;
+PRAGMA mmap_size=268435456;
+"""
+
+# Connections stay open for the life of the process/thread. Reads go through a
+# per-thread query_only connection so they never wait on each other; all writes
+# share one writer connection, serialized by _write_lock (WAL readers don't block it).
+_local = threading.local()
+_writer: Optional[sqlite3.Connection] = None
+_write_lock = threading.Lock()
+
+def _connect() -> sqlite3.Connection:
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, cached_statements=256)
     conn.row_factory = sqlite3.Row
+    conn.executescript(_CONN_PRAGMAS)
     return conn
 
-def init_db():
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS links (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        owner_id TEXT,
-        original_url TEXT NOT NULL,
-        slug TEXT UNIQUE,
-        created_at TEXT
-    );
-    """)
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS clicks (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        link_id INTEGER,
-        ts TEXT,
-        ip TEXT,
-        ua TEXT,
-        device TEXT
-    );
-    """)
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS owners (
-        owner_id TEXT PRIMARY KEY,
-        email TEXT UNIQUE,
-        plan TEXT DEFAULT 'free',
-        stripe_customer_id TEXT,
-        created_at TEXT
-    );
-    """)
+def get_db() -> sqlite3.Connection:
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = _local.conn = _connect()
+        conn.execute("PRAGMA query_only=ON")
+    return conn
+
+@contextmanager
+def write_db():
+    # one transaction per block: commits on exit, rolls back on error
+    global _writer
+    with _write_lock:
+        if _writer is None:
+            _writer = _connect()
+        with _writer:
+            yield _writer
+
+# Hot statements, kept as constants so every call passes the identical string and
+# hits the connection's prepared-statement cache.
+SQL_GET_LINK = "SELECT id, original_url FROM links WHERE slug=?"
+# Plan-cap check and insert in one statement (no race between the check and INSERT);
+# rowcount 0 means the owner is at the free limit, otherwise lastrowid is the new id.
+SQL_INSERT_LINK = """
+INSERT INTO links(owner_id, original_url, slug, created_at)
+SELECT ?, ?, ?, ?
+WHERE (SELECT plan FROM owners WHERE owner_id=?) = 'pro'
+   OR NOT EXISTS (SELECT 1 FROM links WHERE owner_id=? LIMIT 1 OFFSET ?)
+"""
+# the raw user-agent only feeds classify_device(); ip and ua stay empty like they always were
+SQL_INSERT_CLICK = "INSERT INTO clicks(link_id, ts, ip, ua, device) VALUES(?,?,'','',?)"
+SQL_GET_PLAN = "SELECT plan FROM owners WHERE owner_id=?"
+
+# clicks.ts is unix epoch milliseconds (UTC)
+# Plain INTEGER PRIMARY KEY: click ids are never deleted and reused, and AUTOINCREMENT
+# would add a sqlite_sequence update to every flush.
+_CLICKS_COLUMNS = """(
+    id INTEGER PRIMARY KEY,
+    link_id INTEGER,
+    ts INTEGER,
+    ip TEXT,
+    ua TEXT,
+    device INTEGER
+)"""
+
+# clicks.device is stored as a small int; 0 = no user agent
+DEVICE_CODES = {"tablet": 1, "mobile": 2, "desktop": 3}
+
+def _migrate_clicks(conn):
+    # Older databases stored ts as ISO-8601 text and device as a name (TEXT affinity
+    # would coerce integers back to text), and declared id AUTOINCREMENT; any of these
+    # means rebuilding the table rather than altering it in place.
+    # The shape check runs under the same write lock as the rebuild: every uvicorn
+    # worker calls this at import, and a check made before another worker's rebuild
+    # committed would convert already-converted values a second time.
+    conn.execute("BEGIN IMMEDIATE")
+    cols = {r["name"]: r["type"] for r in conn.execute("PRAGMA table_info(clicks)").fetchall()}
+    sql = conn.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name='clicks'").fetchone()["sql"]
+    ts_is_int = cols["ts"].upper() == "INTEGER"
+    device_is_int = cols["device"].upper() == "INTEGER"
+    if ts_is_int and device_is_int and "AUTOINCREMENT" not in sql.upper():
+        conn.commit()
+        return
+    ts_expr = "ts" if ts_is_int else "CAST(ROUND((julianday(ts) - 2440587.5) * 86400000) AS INTEGER)"
+    device_expr = "device" if device_is_int else (
+        "CASE device " + " ".join(f"WHEN '{k}' THEN {v}" for k, v in DEVICE_CODES.items()) + " ELSE 0 END"
+    )
+    # one statement at a time: executescript would commit the open transaction first
+    for stmt in (
+        "DROP TABLE IF EXISTS clicks_new",
+        f"CREATE TABLE clicks_new {_CLICKS_COLUMNS}",
+        f"""INSERT INTO clicks_new(id, link_id, ts, ip, ua, device)
+            SELECT id, link_id, {ts_expr}, ip, ua, {device_expr} FROM clicks""",
+        "DROP TABLE clicks",
+        "ALTER TABLE clicks_new RENAME TO clicks",
+    ):
+        conn.execute(stmt)
     conn.commit()
-    conn.close()
+
+_SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS links (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    owner_id TEXT,
+    original_url TEXT NOT NULL,
+    slug TEXT UNIQUE,
+    created_at TEXT
+);
+CREATE TABLE IF NOT EXISTS clicks {_CLICKS_COLUMNS};
+CREATE TABLE IF NOT EXISTS owners (
+    owner_id TEXT PRIMARY KEY,
+    email TEXT UNIQUE,
+    plan TEXT DEFAULT 'free',
+    stripe_customer_id TEXT,
+    created_at TEXT
+);
+CREATE TABLE IF NOT EXISTS stripe_events (
+    id TEXT PRIMARY KEY,
+    created INTEGER
+);
+"""
+
+# links.slug is already indexed through its UNIQUE constraint
+_INDEXES = """
+CREATE INDEX IF NOT EXISTS idx_links_owner ON links(owner_id);
+CREATE INDEX IF NOT EXISTS idx_clicks_link_ts ON clicks(link_id, ts);
+CREATE INDEX IF NOT EXISTS idx_owners_customer ON owners(stripe_customer_id);
+"""
+
+# Workers start together; one rebuilding clicks can hold the write lock longer than
+# busy_timeout, so the others retry instead of dying at import.
+INIT_DB_ATTEMPTS = 10
+
+def init_db():
+    for attempt in range(1, INIT_DB_ATTEMPTS + 1):
+        try:
+            with write_db() as conn:
+                conn.execute("PRAGMA journal_mode=WAL")
+                # executescript autocommits each statement; one explicit transaction = one
+                # commit. IMMEDIATE takes the write lock up front (waiting on busy_timeout)
+                # instead of failing to upgrade a read lock another worker raced past.
+                conn.executescript(f"BEGIN IMMEDIATE;{_SCHEMA}COMMIT;")
+                _migrate_clicks(conn)
+                conn.executescript(f"BEGIN IMMEDIATE;{_INDEXES}COMMIT;")
+            return
+        except sqlite3.OperationalError as e:
+            if "locked" not in str(e) or attempt == INIT_DB_ATTEMPTS:
+                raise
+            log.warning("database busy during init (attempt %d/%d); retrying", attempt, INIT_DB_ATTEMPTS)
+            time.sleep(1)
 
 init_db()
 
@@ -89,53 +229,222 @@ def email_to_owner_id(email: str) -> str:
     norm = email.strip().lower()
     return hashlib.sha256(norm.encode()).hexdigest()[:24]
 
+# owner_id -> (plan, expires). Writes invalidate locally; the TTL bounds how long
+# other workers can serve a stale plan after a webhook. _PLAN_GEN counts the
+# invalidations per owner, so a read that raced one doesn't cache what it saw.
+PLAN_CACHE_TTL = 30.0
+_PLAN_CACHE: dict = {}
+_PLAN_GEN: dict = {}
+_PLAN_LOCK = threading.Lock()
+
 def upsert_owner(email: str) -> str:
     oid = email_to_owner_id(email)
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("SELECT owner_id FROM owners WHERE owner_id=?", (oid,))
-    row = cur.fetchone()
-    if not row:
-        cur.execute(
-            "INSERT INTO owners(owner_id, email, plan, created_at) VALUES(?,?, 'free', ?)",
+    gen = _PLAN_GEN.get(oid, 0)
+    with write_db() as conn:
+        cur = conn.execute(
+            "INSERT OR IGNORE INTO owners(owner_id, email, plan, created_at) VALUES(?,?, 'free', ?)",
             (oid, email.strip().lower(), dt.datetime.utcnow().isoformat()),
         )
-        conn.commit()
-    conn.close()
+    if cur.rowcount:
+        # new owners always start on free: seed the cache so the plan read that
+        # follows skips the SELECT
+        with _PLAN_LOCK:
+            if _PLAN_GEN.get(oid, 0) == gen:
+                _PLAN_CACHE[oid] = ("free", time.monotonic() + PLAN_CACHE_TTL)
     return oid
 
 def get_plan(owner_id: str) -> str:
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("SELECT plan FROM owners WHERE owner_id=?", (owner_id,))
+    hit = _PLAN_CACHE.get(owner_id)
+    now = time.monotonic()
+    if hit and hit[1] > now:
+        return hit[0]
+    gen = _PLAN_GEN.get(owner_id, 0)
+    cur = get_db().cursor()
+    cur.execute(SQL_GET_PLAN, (owner_id,))
     row = cur.fetchone()
-    conn.close()
-    return row["plan"] if row else "free"
+    if not row:
+        # unknown ids aren't cached, so arbitrary lookups can't grow the dict
+        return "free"
+    with _PLAN_LOCK:
+        if _PLAN_GEN.get(owner_id, 0) == gen:
+            _PLAN_CACHE[owner_id] = (row["plan"], now + PLAN_CACHE_TTL)
+    return row["plan"]
 
-def set_plan(owner_id: str, plan: str):
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("UPDATE owners SET plan=? WHERE owner_id=?", (plan, owner_id))
-    conn.commit()
-    conn.close()
+# The plan setters run inside the caller's write_db() transaction and return the
+# owner ids they touched; call forget_plans() with those once it has committed.
+def set_plan(conn: sqlite3.Connection, owner_id: str, plan: str, customer_id: Optional[str] = None) -> list:
+    # plan and customer land in one UPDATE; a missing customer id keeps the stored one
+    conn.execute(
+        "UPDATE owners SET plan=?, stripe_customer_id=COALESCE(?, stripe_customer_id) WHERE owner_id=?",
+        (plan, customer_id, owner_id),
+    )
+    return [owner_id]
+
+def set_plan_for_customer(conn: sqlite3.Connection, customer_id: str, plan: str) -> list:
+    # SELECT then UPDATE in the same transaction rather than UPDATE ... RETURNING,
+    # which needs SQLite 3.35+
+    rows = conn.execute("SELECT owner_id FROM owners WHERE stripe_customer_id=?", (customer_id,)).fetchall()
+    conn.execute("UPDATE owners SET plan=? WHERE stripe_customer_id=?", (plan, customer_id))
+    return [row["owner_id"] for row in rows]
+
+def forget_plans(owner_ids):
+    with _PLAN_LOCK:
+        for owner_id in owner_ids:
+            _PLAN_GEN[owner_id] = _PLAN_GEN.get(owner_id, 0) + 1
+            _PLAN_CACHE.pop(owner_id, None)
 
-def set_customer(owner_id: str, customer_id: str):
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("UPDATE owners SET stripe_customer_id=? WHERE owner_id=?", (customer_id, owner_id))
-    conn.commit()
-    conn.close()
 
-def owner_link_count(owner_id: str) -> int:
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("SELECT COUNT(*) AS c FROM links WHERE owner_id=?", (owner_id,))
-    c = cur.fetchone()["c"]
-    conn.close()
-    return int(c)
+# -------- SLUG CACHE --------
+# slug -> (link_id, pre-encoded Location header). Links never change once created,
+# so hot slugs skip the SELECT and the per-request URL quoting/header encoding.
+SLUG_CACHE_MAX = 10_000
+_SLUG_CACHE: "OrderedDict[str, tuple[int, bytes]]" = OrderedDict()
+_SLUG_LOCK = threading.Lock()
 
-def can_create_link(owner_id: str) -> bool:
-    return get_plan(owner_id) == "pro" or owner_link_count(owner_id) < 3
+def encode_location(url: str) -> bytes:
+    # same quoting RedirectResponse applies, done once per slug instead of per click
+    return quote(url, safe=":/%#?=@[]!$&'()*+,;").encode("latin-1")
+
+def slug_cache_get(slug: str):
+    with _SLUG_LOCK:
+        hit = _SLUG_CACHE.get(slug)
+        if hit is not None:
+            _SLUG_CACHE.move_to_end(slug)
+        return hit
+
+def slug_cache_put(slug: str, link_id: int, location: bytes):
+    with _SLUG_LOCK:
+        _SLUG_CACHE[slug] = (link_id, location)
+        _SLUG_CACHE.move_to_end(slug)
+        if len(_SLUG_CACHE) > SLUG_CACHE_MAX:
+            _SLUG_CACHE.popitem(last=False)
+
+_REDIRECT_CACHE_HEADER = (
+    [(b"cache-control", f"public, max-age={REDIRECT_MAX_AGE}".encode())] if REDIRECT_MAX_AGE > 0 else []
+)
+
+def redirect_302(location: bytes) -> Response:
+    resp = Response(status_code=302)
+    resp.raw_headers.append((b"location", location))
+    resp.raw_headers.extend(_REDIRECT_CACHE_HEADER)
+    return resp
+
+# -------- DEVICE --------
+# One C-level scan per pattern instead of a Python `in` test per token.
+# Tablet is checked first: iPad/Kindle UAs also carry "Mobile"/"Android".
+_TABLET_RE = re.compile(r"ipad|tablet|kindle|silk/", re.I)
+_MOBILE_RE = re.compile(
+    r"iphone|android|mobile|ipod|iemobile|opera mini|fbav|instagram|tiktok|micromessenger|pinterest|line/",
+    re.I,
+)
+UA_MAX_LEN = 512
+
+# a handful of UA strings make up most traffic, so memoize the classification
+@lru_cache(maxsize=4096)
+def classify_device(ua: str) -> int:
+    if not ua:
+        return 0
+    if _TABLET_RE.search(ua):
+        return DEVICE_CODES["tablet"]
+    if _MOBILE_RE.search(ua):
+        return DEVICE_CODES["mobile"]
+    return DEVICE_CODES["desktop"]
+
+# -------- CLICK LOG --------
+# Redirects only append the raw click to an in-memory buffer; a daemon thread
+# classifies the device and writes the buffer out with one executemany + one
+# commit every CLICK_FLUSH_INTERVAL seconds, or as soon as CLICK_FLUSH_ROWS pile up.
+# The buffer is bounded: while the DB can't be written, clicks past CLICK_BUF_MAX
+# are dropped and counted rather than held in memory, and retries back off.
+CLICK_FLUSH_INTERVAL = 0.1
+CLICK_FLUSH_ROWS = 500
+CLICK_BUF_MAX = 100_000
+CLICK_BACKOFF_MAX = 5.0
+_click_buf: "deque[tuple]" = deque(maxlen=CLICK_BUF_MAX)
+_flush_lock = threading.Lock()
+_flush_now = threading.Event()
+clicks_dropped = 0
+_clicks_dropped_logged = 0
+_flush_failures = 0
+
+def record_click(link_id: int, ts: int, ua: str):
+    global clicks_dropped
+    if len(_click_buf) >= CLICK_BUF_MAX:
+        clicks_dropped += 1
+        return
+    _click_buf.append((link_id, ts, ua))
+    if len(_click_buf) >= CLICK_FLUSH_ROWS:
+        _flush_now.set()
+
+def flush_clicks():
+    global clicks_dropped, _clicks_dropped_logged, _flush_failures
+    with _flush_lock:
+        rows = [_click_buf.popleft() for _ in range(len(_click_buf))]
+        if rows:
+            try:
+                with write_db() as conn:
+                    conn.executemany(
+                        SQL_INSERT_CLICK, [(link_id, ts, classify_device(ua)) for link_id, ts, ua in rows]
+                    )
+            except sqlite3.Error as e:
+                _flush_failures += 1
+                # requeue what still fits, oldest rows first to go
+                batch = len(rows)
+                room = CLICK_BUF_MAX - len(_click_buf)
+                if room < batch:
+                    clicks_dropped += batch - room
+                    rows = rows[batch - room:]
+                _click_buf.extendleft(reversed(rows))
+                if _flush_failures == 1:
+                    log.exception("click flush failed; %d of %d rows requeued", len(rows), batch)
+                else:
+                    log.warning("click flush failed (%d in a row): %s", _flush_failures, e)
+            else:
+                if _flush_failures:
+                    log.warning("click flush recovered after %d failures", _flush_failures)
+                _flush_failures = 0
+        if clicks_dropped != _clicks_dropped_logged:
+            log.warning("click buffer full; %d clicks dropped so far", clicks_dropped)
+            _clicks_dropped_logged = clicks_dropped
+
+def _click_flusher():
+    while True:
+        if _flush_failures:
+            # back off while the DB is unwritable; a full buffer shouldn't wake us early
+            time.sleep(min(CLICK_FLUSH_INTERVAL * 2 ** min(_flush_failures, 8), CLICK_BACKOFF_MAX))
+        else:
+            _flush_now.wait(CLICK_FLUSH_INTERVAL)
+        _flush_now.clear()
+        flush_clicks()
+
+threading.Thread(target=_click_flusher, name="click-flusher", daemon=True).start()
+atexit.register(flush_clicks)
+
+# -------- SLUGS --------
+SLUG_LEN = 7
+SLUG_ATTEMPTS = 5
+# Generated slugs always match; custom slugs are held to the same shape so the
+# redirect can turn away favicon.ico/robots.txt/scanner noise without a lookup.
+SLUG_RE = re.compile(r"[A-Za-z0-9_-]{1,64}")
+
+def load_legacy_slugs() -> frozenset:
+    # Custom slugs created before SLUG_RE was enforced are printed on signs and
+    # flyers, so they keep resolving. create_link rejects new ones, which keeps
+    # this set complete for the life of the process. The GLOB mirrors SLUG_RE.
+    conn = _connect()
+    try:
+        rows = conn.execute(
+            "SELECT slug FROM links WHERE slug GLOB '*[^A-Za-z0-9_-]*' OR length(slug) NOT BETWEEN 1 AND 64"
+        ).fetchall()
+    finally:
+        conn.close()
+    return frozenset(r["slug"] for r in rows)
+
+_LEGACY_SLUGS = load_legacy_slugs()
+
+def make_slug() -> str:
+    # 42 random bits; the UNIQUE constraint on links.slug catches the rare collision
+    return secrets.token_urlsafe(6)[:SLUG_LEN]
 
 # -------- HEALTH --------
 @app.get("/health")
@@ -158,7 +467,7 @@ def create_checkout_session(body: CheckoutBody):
     if not STRIPE_API_KEY or not STRIPE_PRICE_ID:
         raise HTTPException(500, "Stripe not configured")
     try:
-        session = stripe.checkout.Session.create(
+        session = get_stripe().checkout.Session.create(
             mode="subscription",
             line_items=[{"price": STRIPE_PRICE_ID, "quantity": 1}],
             success_url=f"{PUBLIC_APP_DOMAIN}?upgrade=success",
@@ -178,75 +487,123 @@ async def stripe_webhook(request: Request):
     payload = await request.body()
     sig = request.headers.get("stripe-signature")
     try:
-        event = stripe.Webhook.construct_event(payload=payload, sig_header=sig, secret=STRIPE_WEBHOOK_SECRET)
+        event = get_stripe().Webhook.construct_event(payload=payload, sig_header=sig, secret=STRIPE_WEBHOOK_SECRET)
     except Exception as e:
         raise HTTPException(400, f"Invalid payload: {e}")
 
+    # the plan updates are blocking sqlite writes; keep them off the event loop
+    if not await run_in_threadpool(handle_stripe_event, event):
+        return {"received": True, "duplicate": True}
+    return {"received": True}
+
+# Stripe retries deliveries; event ids are kept this long to drop the repeats
+STRIPE_EVENT_TTL = 72 * 3600
+
+def handle_stripe_event(event) -> bool:
+    # The claim and the plan updates commit together: a crash in between rolls both
+    # back, so Stripe's retry is applied instead of being dropped as a duplicate.
+    now = int(time.time())
+    with write_db() as conn:
+        cur = conn.execute("INSERT OR IGNORE INTO stripe_events(id, created) VALUES(?,?)", (event["id"], now))
+        if cur.rowcount == 0:
+            return False
+        conn.execute("DELETE FROM stripe_events WHERE created<?", (now - STRIPE_EVENT_TTL,))
+        touched = apply_stripe_event(conn, event)
+    forget_plans(touched)
+    return True
+
+def apply_stripe_event(conn: sqlite3.Connection, event) -> list:
     etype = event["type"]
+    touched = []
 
     if etype == "checkout.session.completed":
         session = event["data"]["object"]
         owner_id = (session.get("metadata") or {}).get("owner_id")
         customer_id = session.get("customer")
         if owner_id:
-            set_plan(owner_id, "pro")
-            if customer_id:
-                set_customer(owner_id, customer_id)
+            touched += set_plan(conn, owner_id, "pro", customer_id or None)
 
     if etype in ("invoice.payment_succeeded", "customer.subscription.created", "customer.subscription.updated"):
-        obj = event["data"]["object"]
-        customer_id = obj.get("customer")
+        customer_id = event["data"]["object"].get("customer")
         if customer_id:
-            conn = get_db()
-            cur = conn.cursor()
-            cur.execute("SELECT owner_id FROM owners WHERE stripe_customer_id=?", (customer_id,))
-            row = cur.fetchone()
-            conn.close()
-            if row:
-                set_plan(row["owner_id"], "pro")
+            touched += set_plan_for_customer(conn, customer_id, "pro")
 
     if etype in ("customer.subscription.deleted", "customer.subscription.paused"):
-        obj = event["data"]["object"]
-        customer_id = obj.get("customer")
-        conn = get_db()
-        cur = conn.cursor()
-        cur.execute("SELECT owner_id FROM owners WHERE stripe_customer_id=?", (customer_id,))
-        row = cur.fetchone()
-        conn.close()
-        if row:
-            set_plan(row["owner_id"], "free")
+        customer_id = event["data"]["object"].get("customer")
+        if customer_id:
+            touched += set_plan_for_customer(conn, customer_id, "free")
 
-    return {"received": True}
+    return touched
 
 # -------- LINKS --------
 @app.post("/api/links/create")
 def create_link(body: CreateLinkBody):
-    if not can_create_link(body.owner_id):
-        raise HTTPException(403, "Free plan limit reached. Upgrade to Pro for unlimited SmartLinks.")
-    slug = body.slug or hashlib.md5((body.url + body.owner_id + str(dt.datetime.utcnow())).encode()).hexdigest()[:7]
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute(
-        "INSERT INTO links(owner_id, original_url, slug, created_at) VALUES(?,?,?,?)",
-        (body.owner_id, body.url, slug, dt.datetime.utcnow().isoformat()),
-    )
-    conn.commit()
-    conn.close()
+    if body.slug and not SLUG_RE.fullmatch(body.slug):
+        raise HTTPException(400, "Slug may only use letters, digits, '-' and '_' (max 64).")
+    oid = body.owner_id
+    created_at = dt.datetime.utcnow().isoformat()
+    for _ in range(SLUG_ATTEMPTS):
+        slug = body.slug or make_slug()
+        try:
+            with write_db() as conn:
+                cur = conn.execute(
+                    SQL_INSERT_LINK, (oid, body.url, slug, created_at, oid, oid, FREE_LINK_LIMIT - 1)
+                )
+            if cur.rowcount == 0:
+                raise HTTPException(403, "Free plan limit reached. Upgrade to Pro for unlimited SmartLinks.")
+            break
+        except sqlite3.IntegrityError:
+            if body.slug:
+                raise HTTPException(409, "That slug is already taken.")
+    else:
+        raise HTTPException(500, "Could not allocate a slug, please retry.")
+    # pre-warm so the first click on a fresh link (often a QR test scan) skips the SELECT
+    slug_cache_put(slug, cur.lastrowid, encode_location(body.url))
     return {"slug": slug, "short_url": f"/{slug}"}
 
-@app.get("/{slug}")
-def redirect_slug(slug: str):
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("SELECT id, original_url FROM links WHERE slug=?", (slug,))
+def lookup_link(slug: str):
+    cur = get_db().cursor()
+    cur.execute(SQL_GET_LINK, (slug,))
     row = cur.fetchone()
     if not row:
+        return None
+    hit = (row["id"], encode_location(row["original_url"]))
+    slug_cache_put(slug, *hit)
+    return hit
+
+async def resolve_slug(slug: str):
+    # cache hits stay on the event loop; only a miss pays the threadpool hop + SELECT
+    hit = slug_cache_get(slug)
+    if hit is None and (SLUG_RE.fullmatch(slug) or slug in _LEGACY_SLUGS):
+        hit = await run_in_threadpool(lookup_link, slug)
+    if hit is None:
         raise HTTPException(404, "Not found")
-    # minimal click log; extend with IP/UA parsing if needed
-    cur.execute(
-        "INSERT INTO clicks(link_id, ts, ip, ua, device) VALUES(?,?,?,?,?)",
-        (row["id"], dt.datetime.utcnow().isoformat(), "", "", ""),
+    return hit
+
+@app.get("/{slug}")
+async def redirect_slug(slug: str, request: Request):
+    link_id, location = await resolve_slug(slug)
+    ua = request.headers.get("user-agent", "")[:UA_MAX_LEN]
+    record_click(link_id, _time_ns() // 1_000_000, ua)
+    return redirect_302(location)
+
+@app.head("/{slug}")
+async def redirect_slug_head(slug: str):
+    # unfurlers and link checkers probe with HEAD; answer them without logging a click
+    _, location = await resolve_slug(slug)
+    return redirect_302(location)
+
+# -------- ENTRYPOINT --------
+# Each worker is its own process with its own connections and in-memory caches.
+# The slug cache is safe to diverge (links are immutable once created).
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(
+        "redirect_server:app",
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", "8000")),
+        workers=int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1)),
+        loop="uvloop",
+        http="httptools",
+        log_level="warning",
     )
-    conn.commit()
-    conn.close()
-    return RedirectResponse(url=row["original_url"])
@@ -0,0 +1,118 @@
+# Migrating a baseline-schema database (clicks.ts as ISO text, device as a name,
+# AUTOINCREMENT ids). redirect_server runs init_db() at import, so each "worker"
+# is a fresh interpreter importing it against the same DB_PATH.
+import datetime as dt
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import unittest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BASELINE_SCHEMA = """
+CREATE TABLE links (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    owner_id TEXT,
+    original_url TEXT NOT NULL,
+    slug TEXT UNIQUE,
+    created_at TEXT
+);
+CREATE TABLE clicks (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    link_id INTEGER,
+    ts TEXT,
+    ip TEXT,
+    ua TEXT,
+    device TEXT
+);
+CREATE TABLE owners (
+    owner_id TEXT PRIMARY KEY,
+    email TEXT UNIQUE,
+    plan TEXT DEFAULT 'free',
+    stripe_customer_id TEXT,
+    created_at TEXT
+);
+"""
+
+DEVICES = ["mobile", "desktop", "tablet", ""]
+START = dt.datetime(2026, 10, 15, 22, 17, 53, 740215)
+
+
+def baseline_ts(i):
+    return (START + dt.timedelta(seconds=i)).isoformat()
+
+
+def expected_ms(i):
+    return round((START + dt.timedelta(seconds=i)).replace(tzinfo=dt.timezone.utc).timestamp() * 1000)
+
+
+class MigrateClicksTest(unittest.TestCase):
+    ROWS = 20_000
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmp.name, "smartlinks.sqlite3")
+        db = sqlite3.connect(self.db_path)
+        db.executescript(BASELINE_SCHEMA)
+        db.execute("INSERT INTO links(owner_id, original_url, slug, created_at) VALUES('o', 'https://x', 'abc', '')")
+        db.executemany(
+            "INSERT INTO clicks(link_id, ts, ip, ua, device) VALUES(1, ?, '', '', ?)",
+            [(baseline_ts(i), DEVICES[i % len(DEVICES)]) for i in range(self.ROWS)],
+        )
+        db.commit()
+        db.close()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def start_worker(self):
+        env = dict(os.environ, DB_PATH=self.db_path, PYTHONPATH=REPO)
+        return subprocess.Popen(
+            [sys.executable, "-c", "import redirect_server"],
+            env=env, stderr=subprocess.PIPE, text=True,
+        )
+
+    def run_workers(self, n):
+        procs = [self.start_worker() for _ in range(n)]
+        for proc in procs:
+            _, err = proc.communicate(timeout=120)
+            self.assertEqual(proc.returncode, 0, err)
+
+    def assert_migrated(self):
+        db = sqlite3.connect(self.db_path)
+        try:
+            cols = {r[1]: r[2] for r in db.execute("PRAGMA table_info(clicks)")}
+            self.assertEqual(cols["ts"], "INTEGER")
+            self.assertEqual(cols["device"], "INTEGER")
+            sql = db.execute("SELECT sql FROM sqlite_master WHERE name='clicks'").fetchone()[0]
+            self.assertNotIn("AUTOINCREMENT", sql.upper())
+
+            rows = db.execute("SELECT id, ts, typeof(ts), device FROM clicks ORDER BY id").fetchall()
+            self.assertEqual(len(rows), self.ROWS)
+            codes = {"": 0, "tablet": 1, "mobile": 2, "desktop": 3}
+            for i, (rowid, ts, ts_type, device) in enumerate(rows):
+                self.assertEqual(rowid, i + 1)
+                self.assertEqual(ts_type, "integer")
+                self.assertLessEqual(abs(ts - expected_ms(i)), 1)
+                self.assertEqual(device, codes[DEVICES[i % len(DEVICES)]])
+        finally:
+            db.close()
+
+    def test_baseline_db_is_migrated(self):
+        self.run_workers(1)
+        self.assert_migrated()
+
+    def test_migration_is_idempotent(self):
+        self.run_workers(1)
+        self.run_workers(1)
+        self.assert_migrated()
+
+    def test_concurrent_workers_migrate_once(self):
+        self.run_workers(4)
+        self.assert_migrated()
+
+
+if __name__ == "__main__":
+    unittest.main()